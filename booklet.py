@@ -6,7 +6,8 @@
  date: 2021
 """
 
-import argparse, pathlib, logging
+import os, sys, argparse, pathlib, logging, multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from gpxmap import GPXMap
 
 from config import *
@@ -19,6 +20,35 @@ htmlTrack = '<center> <h2>{name}</h2><p><img style="border:5px solid"; src="{map
 
 htmlEnd = '</body></html>'
 
+def renderMap(gpx, cache, trackNum, resolution, path):
+  '''
+  build the map of the given track and save it in path
+  '''
+  logger.info(f'mapping track {trackNum+1}/{gpx.nbTracks}')
+  mapImg = GPXMap(gpx, trackNum=trackNum, resolution = resolution, cache = cache)
+  mapImg.mapImg.save(str(path),'png')
+
+# gpx and cache of the booklet in the map rendering processes (see initMapWorker)
+workerGPX = None
+workerCache = None
+
+def initMapWorker(gpx, cache):
+  '''
+  store the gpx and the cache inherited by a forked map rendering process
+  the process may not remove the DEM tiles: it does not see the pins
+  of the parent process, which may be loading them
+  '''
+  global workerGPX, workerCache
+  cache.keepPriority = True
+  workerGPX = gpx
+  workerCache = cache
+
+def renderMapWorker(trackNum, resolution, path):
+  '''
+  renderMap in a map rendering process
+  '''
+  renderMap(workerGPX, workerCache, trackNum, resolution, path)
+
 class Booklet():
 
   def __init__(self, gpx, cache, resolution = RESOLUTION):
@@ -26,6 +56,19 @@ class Booklet():
     self.cache = cache
     self.gpx = gpx
 
+  def downloadMapTiles(self):
+    '''
+    download the missing tiles of all the maps: the tiles shared by several maps
+    are downloaded once, and the tile server gets at most DOWNLOAD_WORKERS
+    concurrent requests rather than DOWNLOAD_WORKERS per map rendering process
+    '''
+    for i in range (0, self.gpx.nbTracks):
+      m = GPXMap(self.gpx, trackNum=i, resolution = self.resolution, cache = self.cache,
+                 tilesOnly = True)
+      xyList = m.getTileList(missing = True)
+      if xyList:
+        m.downloadTiles(xyList)
+
   def write(self, dirPath):
 
     try:
@@ -34,7 +77,31 @@ class Booklet():
       logger.error(f'unable to create directory {str(dirPath)}')
       exit(-1)
 
-    html = htmlStart
+    # the maps only depend on the track coordinates: with several tracks and CPUs,
+    # they are rendered in forked processes (sharing the cache directory) while
+    # the tracks are processed, once their tiles have been downloaded (see
+    # downloadMapTiles). The processes are forked first, before any
+    # thread is started by the track processing. Fork is only used on Linux
+    # (unsafe with the macOS system libraries, which default to spawn).
+    workers = min(self.gpx.nbTracks, os.cpu_count() or 1)
+    executor = None
+    if workers > 1 and sys.platform.startswith('linux'):
+      self.downloadMapTiles()
+      executor = ProcessPoolExecutor(max_workers = workers,
+                                     mp_context = multiprocessing.get_context('fork'),
+                                     initializer = initMapWorker,
+                                     initargs = (self.gpx, self.cache))
+      maps = [executor.submit(renderMapWorker, i, self.resolution,
+                              dirPath.joinpath(f'map{i+1:02d}.png'))
+              for i in range (0, self.gpx.nbTracks)]
+    else:
+      # the tiles of all the maps are downloaded in the background while the
+      # tracks are processed (DEM download and elevation computation)
+      for i in range (0, self.gpx.nbTracks):
+        GPXMap(self.gpx, trackNum=i, resolution = self.resolution, cache = self.cache,
+               prefetchOnly = True)
+
+    html = [htmlStart]
     for i in range (0, self.gpx.nbTracks):
       logger.info(f'processing track {i+1}/{self.gpx.nbTracks}')
       self.gpx.processTracks(i)
@@ -44,19 +111,26 @@ class Booklet():
       data['width'] = self.resolution
       profile = self.gpx.getProfile(i, resolution = self.resolution)
       profile.save(str(dirPath.joinpath(data['profilePath'])), 'png')
-      logger.info(f'mapping track {i+1}/{self.gpx.nbTracks}')
-      mapImg = GPXMap(self.gpx, trackNum=i,
-                      resolution = self.resolution, cache = self.cache)
-      mapImg.mapImg.save(str(dirPath.joinpath(data['mapPath'])),'png')
-      html+= htmlTrack.format(**data)
+      if not executor:
+        renderMap(self.gpx, self.cache, i, self.resolution, dirPath.joinpath(data['mapPath']))
+      html.append(htmlTrack.format_map(data))
       if logger.level <= logging.INFO:
         self.gpx.printSummary(i)
-    html += htmlEnd
+    html.append(htmlEnd)
+
+    if executor:
+      with executor:
+        for m in maps:
+          m.result()
+      # take the files stored by the map rendering processes into account:
+      # each one only removed files according to its own copy of the index
+      self.cache.scan()
+      self.cache.clean()
 
     try:
       path = dirPath.joinpath('index.html')
       with open(path,'w') as f:
-        f.write(html)
+        f.write(''.join(html))
     except:
       logger.error('unable to save booklet in file {str(path)}')
 
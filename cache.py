@@ -6,31 +6,178 @@
  date: 2021
 """
 
-import pathlib, base64, logging
+import os, time, random, fnmatch, pathlib, base64, shutil, weakref, threading, logging
+from collections import OrderedDict, Counter, deque
 
 from config import *
 
 logger=logging.getLogger(__name__)
 
+# the cache directories of the process (see resetLocks)
+_INSTANCES = weakref.WeakSet()
+
+def resetLocks():
+  '''
+  a forked process may inherit the locks while they are held by other threads
+  '''
+  for cache in _INSTANCES:
+    cache.lock = threading.Lock()
+
+if hasattr(os, 'register_at_fork'):
+  os.register_at_fork(after_in_child=resetLocks)
+
 class CacheDir():
-  def __init__(self, path = CACHE_PATH, maxSize = CACHE_MAX_SIZE, keep = CACHE_KEEP):
+  def __init__(self, path = CACHE_PATH, maxSize = CACHE_MAX_SIZE, keep = CACHE_KEEP,
+               priority = CACHE_PRIORITY, maxImages = IMAGE_CACHE_SIZE):
     '''
     a basic disk cache directory management
 
     path: cache path
     maxSize: cache max size in MB
     keep: list of filenames to be kept permanently
+    priority: list of filename patterns to be removed last
+    maxImages: number of decoded images kept in memory (see getImage and keepImage)
     '''
     self.maxSize = maxSize*1024*1024
     self.path = pathlib.Path(path).expanduser()
     self.keep = keep
+    self.priority = priority
+    # the cache may be updated by concurrent downloads
+    self.lock = threading.Lock()
+    _INSTANCES.add(self)
     if not self.path.exists():
       self.path.mkdir()
 
+    # in memory index of the cache files (see scan) and the files that
+    # may be removed by clean, by removal order [[filename], [priority filename]]
+    self.index = {}
+    self.tiers = [[], []]
+    self.scan()
+
+    # files being used, never removed from the cache (see pin) {filename: count}
+    self.pinned = Counter()
+    # the last written files are never removed either
+    self.recent = deque(maxlen = 2)
+    # never remove the files matching a priority pattern, e.g. in a process
+    # which does not see the pins of the others (see booklet.initMapWorker)
+    self.keepPriority = False
+
+    # in memory LRU of the decoded images {filename: read-only RGB array}
+    self.maxImages = maxImages
+    self.images = OrderedDict()
+
+  def scan(self):
+    '''
+    (re)build the in memory index of the cache files {filename: [size, last access time, hits, tier]}
+    from the cache directory, e.g. after it has been updated by other processes
+    '''
+    index = {}
+    with os.scandir(self.path) as it:
+      for e in it:
+        if not e.is_file():
+          continue
+        if e.name.endswith('.part'):
+          # file left incomplete by an interrupted process (e.g. a background download)
+          if time.time() - e.stat().st_mtime > 3600:
+            pathlib.Path(e.path).unlink(missing_ok = True)
+          continue
+        index[e.name] = [e.stat().st_size, e.stat().st_mtime, 0, None]
+    with self.lock:
+      # keep the hits of the files already known
+      for name, entry in index.items():
+        if name in self.index:
+          entry[2] = self.index[name][2]
+      self.index = {}
+      self.tiers = [[], []]
+      for name, entry in index.items():
+        self.addEntry(name, entry)
+      self.size = sum(v[0] for v in self.index.values())
+
+  def getTier(self, filename):
+    '''
+    return the removal tier of the file: 0, 1 for the files matching
+    a priority pattern (removed last) or None for the kept files
+    '''
+    if filename in self.keep:
+      return None
+    return 1 if any(fnmatch.fnmatch(filename, p) for p in self.priority) else 0
+
+  def addEntry(self, filename, entry):
+    '''
+    add the entry of a new file to the index and to its tier
+    (the lock must be held)
+    '''
+    tier = entry[3] = self.getTier(filename)
+    if tier is not None:
+      # position of the file in its tier, for a O(1) removal (see removeEntry)
+      entry.append(len(self.tiers[tier]))
+      self.tiers[tier].append(filename)
+    self.index[filename] = entry
+
+  def removeEntry(self, filename):
+    '''
+    remove the entry of the file from the index and from its tier
+    return the entry or None (the lock must be held)
+    '''
+    entry = self.index.pop(filename, None)
+    if entry and entry[3] is not None:
+      # swap with the last file of the tier
+      candidates = self.tiers[entry[3]]
+      last = candidates.pop()
+      if last != filename:
+        candidates[entry[4]] = last
+        self.index[last][4] = entry[4]
+    return entry
+
+  def pin(self, filename):
+    '''
+    prevent the given file (present or about to be written) from being removed
+    from the cache until it is unpinned
+    '''
+    with self.lock:
+      self.pinned[filename] += 1
+
+  def unpin(self, filename):
+    '''
+    release a file pinned with pin
+    '''
+    with self.lock:
+      self.pinned[filename] -= 1
+      if self.pinned[filename] <= 0:
+        del self.pinned[filename]
+
+  def updateIndex(self, path, modified = False):
+    '''
+    record an access to the given cache file
+    modified: the file has been (re)written
+    '''
+    with self.lock:
+      if modified:
+        self.images.pop(path.name, None)
+        self.recent.append(path.name)
+      entry = self.index.get(path.name)
+      if entry and not modified:
+        entry[1] = time.time()
+        entry[2] += 1
+      else:
+        size = path.stat().st_size
+        self.size += size - (entry[0] if entry else 0)
+        if entry:
+          entry[:3] = [size, time.time(), 0]
+        else:
+          self.addEntry(path.name, [size, time.time(), 0, None])
+
+  def exists(self, filename):
+    '''
+    tell whether the file is in the cache without counting it as an access
+    '''
+    return self.path.joinpath(filename).exists()
+
   def check(self, filename):
     p = self.path.joinpath(filename)
     if p.exists():
       p.touch()
+      self.updateIndex(p)
       return p
     else:
       return None
@@ -40,6 +187,7 @@ class CacheDir():
     data = None
     if path.exists():
       path.touch()
+      self.updateIndex(path)
       with open(path,'rb') as f:
         data = f.read()
         if crypt:
@@ -47,22 +195,152 @@ class CacheDir():
         logger.debug(f'retrieving file "{filename}" from cache')
     return data
 
+  def loadManyData(self, filenames):
+    '''
+    batched version of loadData: return the list of the files data (None if not in the cache)
+    the files are opened without prior existence check and the index updated at once
+    '''
+    dataList = []
+    for filename in filenames:
+      path = self.path.joinpath(filename)
+      data = None
+      try:
+        with open(path,'rb') as f:
+          data = f.read()
+        logger.debug(f'retrieving file "{filename}" from cache')
+      except FileNotFoundError:
+        pass
+      dataList.append(data)
+      if data is not None:
+        # the file may have been removed meanwhile by another thread or process
+        try:
+          os.utime(path)
+        except FileNotFoundError:
+          pass
+
+    unknown = []
+    now = time.time()
+    with self.lock:
+      for filename, data in zip(filenames, dataList):
+        if data is None:
+          continue
+        entry = self.index.get(filename)
+        if entry:
+          entry[1] = now
+          entry[2] += 1
+        else:
+          unknown.append(filename)
+    # files written by another process
+    for filename in unknown:
+      try:
+        self.updateIndex(self.path.joinpath(filename))
+      except FileNotFoundError:
+        pass
+    return dataList
+
+  def getImage(self, filename):
+    '''
+    return the decoded image kept in memory (read-only RGB array) for the given cache file, or None
+    '''
+    with self.lock:
+      img = self.images.get(filename)
+      if img is not None:
+        self.images.move_to_end(filename)
+    if img is not None:
+      self.updateIndex(self.path.joinpath(filename))
+    return img
+
+  def keepImage(self, filename, img):
+    '''
+    keep in memory the decoded image (RGB array) of the given cache file
+    return the image, made read-only since it is shared
+    '''
+    img.flags.writeable = False
+    with self.lock:
+      self.images[filename] = img
+      self.images.move_to_end(filename)
+      if len(self.images) > self.maxImages:
+        self.images.popitem(last = False)
+    return img
+
   def saveData(self, filename, data, crypt = False):
     if crypt:
       data = base64.b64encode(data)
     path = self.path.joinpath(filename)
-    with open(path,'wb') as f:
+    # write then rename so that concurrent readers or writers never see a partial file
+    tmpPath = self.getTmpPath(path)
+    with open(tmpPath,'wb') as f:
       f.write(data)
-      logger.debug(f'storing file "{filename}" in cache')
+    tmpPath.replace(path)
+    logger.debug(f'storing file "{filename}" in cache')
+    self.updateIndex(path, modified = True)
     self.clean()
     return path
 
-  def clean(self):
-    dirSize = sum(f.stat().st_size for f in self.path.glob('**/*') if f.is_file())
-    files = sorted([*self.path.iterdir()], key=lambda p: p.stat().st_mtime, reverse = True)
-    while len(files) > 2  and dirSize > self.maxSize:
-      f = files.pop()
-      if not str(f.name) in self.keep:
-        dirSize -= f.stat().st_size
-        f.unlink()
-        logger.debug(f'removing  file "{filename}" from cache')
+  def saveStream(self, filename, stream):
+    '''
+    store the content of a file-like object in the cache without buffering
+    it in memory (the file is renamed once complete)
+    '''
+    path = self.path.joinpath(filename)
+    tmpPath = self.getTmpPath(path)
+    try:
+      with open(tmpPath,'wb') as f:
+        shutil.copyfileobj(stream, f, 1<<20)
+    except:
+      tmpPath.unlink(missing_ok = True)
+      raise
+    tmpPath.replace(path)
+    logger.debug(f'storing file "{filename}" in cache')
+    self.updateIndex(path, modified = True)
+    self.clean()
+    return path
+
+  def getTmpPath(self, path):
+    '''
+    return a temporary path, unique to the current thread, for writing the given path
+    '''
+    return path.with_name(f'{path.name}.{os.getpid()}-{threading.get_ident()}.part')
+
+  def remove(self, filename):
+    '''
+    remove the given file from the cache
+    '''
+    with self.lock:
+      entry = self.removeEntry(filename)
+      if entry:
+        self.size -= entry[0]
+      self.images.pop(filename, None)
+      self.path.joinpath(filename).unlink(missing_ok = True)
+    logger.debug(f'removing  file "{filename}" from cache')
+
+  def clean(self, samples = 8):
+    '''
+    remove files until the cache size is below maxSize
+    the removed file is the one with the highest LRU-SP cost
+    (time since last access * size / hits) among a few randomly sampled files
+    the pinned files and the last written ones are never removed
+    '''
+    with self.lock:
+      # files matching a priority pattern are only removed once the others are
+      for candidates in self.tiers[:1] if self.keepPriority else self.tiers:
+        while self.size > self.maxSize and len(self.index) > 2:
+          # enough samples for at least one of them not to be pinned or recent
+          n = min(samples + len(self.pinned) + len(self.recent), len(candidates))
+          sample = [f for f in random.sample(candidates, n)
+                    if not (f in self.pinned or f in self.recent)]
+          if not sample:
+            break
+          now = time.time()
+          filename = max(sample, key=lambda f: self.cost(self.index[f], now))
+          self.size -= self.removeEntry(filename)[0]
+          self.images.pop(filename, None)
+          self.path.joinpath(filename).unlink(missing_ok = True)
+          logger.debug(f'removing  file "{filename}" from cache')
+
+  def cost(self, entry, now):
+    '''
+    LRU-SP eviction cost of a cache index entry
+    '''
+    size, lastAccess, hits = entry[:3]
+    return (now - lastAccess) * size / max(1, hits)
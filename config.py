@@ -15,6 +15,9 @@ RESOLUTION = 1024
 # track and point colors
 COLORS = ['#236AB9','#FC7307']
 
+# size in pixel of the (square) map tiles
+TILE_PX = 256
+
 # url for map requests
 URL_MAP=r'https://tile.opentopomap.org/{}/{}/{}.png'
 # idem for openstreetmap
@@ -26,14 +29,33 @@ URL_DEM_AUTH = 'urs.earthdata.nasa.gov'
 
 # tile name format for DEM files
 DEM_TILE_NAME = r'{}.SRTMGL1.hgt.zip'
+# idem for the uncompressed DEM files stored in the cache
+DEM_RAW_TILE_NAME = r'{}.SRTMGL1.hgt.raw'
 
 DEM_RESOLUTION = 3601 # 3601x3601 for STRM1 and 1201x101 SRTM3
 
+# maximum number of concurrent tile downloads
+DOWNLOAD_WORKERS = 8
+
+# number of tiles around each map to be downloaded in the background
+# in order to warm the cache for neighbouring maps (0 to disable)
+PREFETCH_RADIUS = 0
+
+# also store the map tiles in the cache as lossless WebP images,
+# faster to decode than the PNG images served by the tile server
+ENABLE_WEBP_TILE_CACHE = False
+
 # cache directory for the map tiles
 CACHE_PATH = '~/.cache/hikebooklet'
 
 # cache size in MB
 CACHE_MAX_SIZE = 128
 
+# number of decoded map tiles kept in memory (about 200KB each)
+IMAGE_CACHE_SIZE = 1024
+
 # list of file to be kept permanently in cache
 CACHE_KEEP = ['usgs.dat']
+
+# list of filename patterns only removed from cache when no other file can be
+CACHE_PRIORITY = ['*.hgt.raw']
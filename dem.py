@@ -6,11 +6,12 @@
  date: 2021
 """
 
-import sys,io,zipfile,struct,logging
+import sys,zipfile,shutil,tempfile,logging
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 import numpy as np
-from PIL import Image, ImageDraw, ImageColor
 
 from config import *
 
@@ -53,6 +54,9 @@ class DEM ():
     '''
     self.cache = cache
 
+    # HTTP session shared by the tile downloads (keep-alive)
+    self.session = None
+
     # store USGS auth or try to retrieve it from cache
     if  username and password:
       self.auth = (username, password)
@@ -72,99 +76,150 @@ class DEM ():
     data = self.auth[0]+':'+self.auth[1]
     self.cache.saveData('usgs.dat', data.encode('ascii'), crypt = True)
 
-  def getTile(self, filename):
+  def getTile(self, tileId):
     '''
-    load  DEM tile from the cache directory or download it from USGS
-    if not present in the cache
+    return the path of the uncompressed DEM tile from the cache directory, or None
+    if not present in the cache, the zipped tile is downloaded from USGS in a temporary
+    file (out of the cache) and its .hgt file extracted once in the cache.
+    The tile is pinned in the cache and must be released with releaseTile once loaded
     '''
+    tileName = DEM_RAW_TILE_NAME.format(tileId)
+    self.cache.pin(tileName)
 
     # try to find the DEM tile in the cache
-    tilePath = self.cache.check(filename)
-
-    # if not present in the cache, download the tile and store it in the cache
+    tilePath = self.cache.check(tileName)
+    if tilePath:
+      return tilePath
+
+    # zipped tile stored in the cache by a previous version
+    filename = DEM_TILE_NAME.format(tileId)
+    self.cache.pin(filename)
+    try:
+      zipPath = self.cache.check(filename)
+      if zipPath:
+        tilePath = self.extractTile(zipPath, tileId)
+        self.cache.remove(filename)
+    finally:
+      self.cache.unpin(filename)
+
+    # if not present in the cache, download the zipped tile
     if not tilePath:
-      logger.info('downloading DEM tile {filename}')
+      logger.info(f'downloading DEM tile {filename}')
       url = URL_DEM.format(filename)
       try:
-        with SessionWithHeaderRedirection(self.auth) as s:
-          r = s.get(url)
-          r.raise_for_status()
-          tilePath = self.cache.saveData(filename, r.content)
+        with tempfile.TemporaryFile() as tmp:
+          with self.session.get(url, stream=True) as r:
+            r.raise_for_status()
+            r.raw.decode_content = True
+            shutil.copyfileobj(r.raw, tmp, 1<<20)
+          tilePath = self.extractTile(tmp, tileId)
       except requests.exceptions.HTTPError as e:
         logger.error(f'unable to download DEM tile {filename} from server (HTTP error: {e.response.status_code})')
+
+    if not tilePath:
+      self.cache.unpin(tileName)
     return tilePath
 
+  def extractTile(self, zipFile, tileId):
+    '''
+    extract the .hgt file of the given zipped tile (path or file object) in the cache
+    return its path
+    '''
+    with zipfile.ZipFile(zipFile) as z:
+      with z.open(tileId+'.hgt','r') as f:
+        return self.cache.saveStream(DEM_RAW_TILE_NAME.format(tileId), f)
+
+  def releaseTile(self, tileId):
+    '''
+    allow the given DEM tile returned by getTile to be removed from the cache
+    '''
+    self.cache.unpin(DEM_RAW_TILE_NAME.format(tileId))
+
   def getElevation(self, pointList):
     '''
-    get elevation information for a list of points from DEM tiles
+    get elevation information for a structured array of points (lat, lon and ele
+    columns, see gpx.POINT_DTYPE) from DEM tiles
     for the sake of speed, all the points belonging to the same tile are batch processed
     '''
+    lats = pointList['lat']
+    lons = pointList['lon']
+    eles = pointList['ele']
 
-    # count the number of point needing to be processed
-    Npt = [0 if not 'b' in p or not p['b'] else 1 for p in pointList].count(0)
-
-    if not Npt:
+    # nothing to do if every point has an elevation
+    if eles.all():
       return
 
     logger.info(f'retrieving track point elevations')
 
-    while True:
-      # retrieve the first point with no elevation information
-      tileLat = None
-      tileLon = None
-      for p in pointList:
-        if not 'ele' in p or not p['ele']:
-          tileLat = int(p['lat'])
-          tileLon = int(p['lon'])
-          break
-      if not tileLat:
-        break
-
-      # get the DEM tile corresponding to the point lat/llon degrees (integer parts)
-      tileId = '{}{:02d}{}{:03d}'.format('S' if tileLat < 0 else 'N', tileLat,
-                                         'W' if tileLon < 0 else 'E', tileLon)
-      tileFilename = DEM_TILE_NAME.format(tileId)
-      tilePath = self.getTile(tileFilename)
-
-      if tilePath:
-        # open the zip file and get elevation for all point inside  the DEM tile
-        with zipfile.ZipFile(tilePath) as z:
-          filename = tileFilename[:tileFilename.rfind('.')] # remove .zip
-          with z.open(tileId+'.hgt','r') as f:
-            tile  = f.read()
-            for pt in pointList:
-              if int(pt['lat']) == tileLat and int(pt['lon']) == tileLon:
-                pt['ele'] = self.computePointElevation(pt, tile)
+    # group the point indices by DEM tile (lat/lon degrees integer parts) in one pass
+    tileLats = lats.astype(int).tolist()
+    tileLons = lons.astype(int).tolist()
+    groups = defaultdict(list)
+    for i, k in enumerate(zip(tileLats, tileLons)):
+      groups[k].append(i)
+
+    # DEM tiles of the points with no elevation information in the order of their first point
+    missing = np.flatnonzero(eles == 0).tolist()
+    tiles = list(dict.fromkeys((tileLats[i], tileLons[i]) for i in missing))
+
+    # download the DEM tiles concurrently
+    if not self.session:
+      self.session = SessionWithHeaderRedirection(self.auth)
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+      tilePaths = {k: executor.submit(self.getTile, self.getTileId(*k)) for k in tiles}
+
+      # process the tiles in order as soon as they are available
+      for k in tiles:
+        tilePath = tilePaths[k].result()
+        inTile = np.array(groups[k])
+        if tilePath:
+          # get elevation for all point inside  the DEM tile
+          try:
+            tile = self.loadTile(tilePath)
+            eles[inTile] = self.computeTileElevation(tile, lats[inTile], lons[inTile])
             del tile
-      else:
-        # no DEM tile so set elevation to the last elevation value if any, or 1cm
-        lastValue = 0.001
-        for pt in pointList:
-          if not 'ele' in pt or not pt['ele']:
-            if int(pt['lat']) == tileLat and int(pt['lon']) == tileLon:
-              pt['ele'] = lastValue
-          else:
-            lastValue = pt['ele']
-
-  def computePointElevation(self, pt, tile):
-    '''
-    return elevation for the given point using bilinear interpolation of DEM tile data
-    DEM data are DEM_RESOLUTION x DEM_RESOLUTION big endian uint16
-    '''
-    # get coordinate position in the tile
-    x = (pt['lon'] % 1) * DEM_RESOLUTION
-    y = (1 - pt['lat'] % 1) * DEM_RESOLUTION - 1
+          finally:
+            self.releaseTile(self.getTileId(*k))
+        else:
+          # no DEM tile so set elevation to the last elevation value if any, or 1cm
+          known = np.where(eles != 0, np.arange(len(eles)), -1)
+          known = np.maximum.accumulate(known)
+          lastValue = np.where(known >= 0, eles[known], 0.001)
+          fill = inTile[eles[inTile] == 0]
+          eles[fill] = lastValue[fill]
+
+  def loadTile(self, tilePath):
+    '''
+    return the DEM tile data as a DEM_RESOLUTION x DEM_RESOLUTION big endian uint16 array
+    memory mapped from the uncompressed tile file
+    '''
+    return np.memmap(tilePath, dtype='>u2', mode='r', shape=(DEM_RESOLUTION, DEM_RESOLUTION))
+
+  def getTileId(self, tileLat, tileLon):
+    '''
+    return the id of the DEM tile for the given lat/lon degrees (integer parts)
+    '''
+    return '{}{:02d}{}{:03d}'.format('S' if tileLat < 0 else 'N', tileLat,
+                                     'W' if tileLon < 0 else 'E', tileLon)
+
+  def computeTileElevation(self, tile, lats, lons):
+    '''
+    return elevations for the given lat/lon arrays using bilinear interpolation of DEM tile data
+    tile is the DEM_RESOLUTION x DEM_RESOLUTION big endian uint16 array of the DEM tile
+    '''
+    # get coordinate positions in the tile
+    x = (lons % 1) * DEM_RESOLUTION
+    y = (1 - lats % 1) * DEM_RESOLUTION - 1
+    fx = x % 1
+    fy = y % 1
     # retrieve neighbors values
-    v = [[0,0],[0,0]]
-    for i in range(0,2):
-      for j in range(0,2):
-        xx = min(int(x) + i, DEM_RESOLUTION - 1)
-        yy = max(int(y) - j, 0)
-        pos = (xx + yy * DEM_RESOLUTION) * 2
-        v[i][j] = struct.unpack('>H',tile[pos:pos+2])[0] # uint16  big endian
+    x0 = x.astype(int)
+    x1 = np.minimum(x0 + 1, DEM_RESOLUTION - 1)
+    y0 = np.maximum(y.astype(int), 0)
+    y1 = np.maximum(y0 - 1, 0)
     # bilinear interpolation between neighbors
-    value =  v[0][0] * (1 - x % 1) * (1 - y % 1)\
-           + v[0][1] * (x % 1)     * (1 - y % 1)\
-           + v[1][0] * (1 - x % 1) * (y % 1)\
-           + v[1][1] * (x % 1)     * (y % 1)
-    return(round(value))
+    value =  tile[y0, x0] * (1 - fx) * (1 - fy)\
+           + tile[y1, x0] * fx       * (1 - fy)\
+           + tile[y0, x1] * (1 - fx) * fy\
+           + tile[y1, x1] * fx       * fy
+    return np.round(value).astype(int)
@@ -6,20 +6,53 @@
  date: 2021
 """
 
-import datetime, pathlib, logging
+import datetime, math, re, pathlib, functools, logging
 import xml.etree.ElementTree as ET
 
-import requests
 import numpy as np
 from PIL import Image, ImageDraw, ImageFont
 
 from config import *
 
+try:
+  # faster C parser if lxml is available
+  import lxml.etree
+  iterparse = functools.partial(lxml.etree.iterparse, remove_comments=True, remove_pis=True)
+except ImportError:
+  iterparse = ET.iterparse
+
 logger=logging.getLogger(__name__)
 
 RADIUS_EQUATOR = 6378137 # radius in meter of the earth at equator
 RADIUS_POLE    = 6356752 # radius in meter of the earth at poles
 
+# track points are stored as structured arrays (one column per value)
+POINT_DTYPE = np.dtype([('lat','f8'), ('lon','f8'), ('ele','f8'), ('time','f8'),
+                        ('dist','f8'), ('ascent','f8'), ('descent','f8'), ('name','O')])
+
+# accepted GPX time formats: %Y-%m-%dT%H:%M:%S[.%f]Z and %Y-%m-%d %H:%M:%S[.%f]
+TIME_RE = re.compile(r'\d{4}-\d{2}-\d{2}[T ](\d{2}):(\d{2}):\d{2}(?:\.\d{1,6})?Z?$')
+
+@functools.lru_cache()
+def getTrackKernel():
+  '''
+  return the compiled track processing (see kernels.py) if numba is available, or None
+  numba is imported on first use only since it takes a while to load
+  '''
+  try:
+    from kernels import computeTrack
+  except ImportError:
+    return None
+  return computeTrack
+
+@functools.lru_cache()
+def getFont(size):
+  '''
+  return the booklet font at the given size (loaded once per process)
+  '''
+  p = pathlib.Path(__file__).parent
+  return ImageFont.truetype(str(p.joinpath('fonts/FreeMonoBold.ttf')), size)
+
 def computeHikingTime(distance, slope, flatSpeed = FLAT_SPEED):
   '''
   Estimate hiking time of a route using Tobler model
@@ -32,7 +65,7 @@ def computeHikingTime(distance, slope, flatSpeed = FLAT_SPEED):
   ratio = flatSpeed/5.
   distance /= 1000. # -> km
   slope /= 1000. # -> km
-  speed = (6*np.exp(-3.5*np.abs(slope/distance+0.05)))
+  speed = (6*math.exp(-3.5*abs(slope/distance+0.05)))
   hours = distance/speed/ratio
   return hours
 
@@ -43,33 +76,80 @@ def computeDistance(pt1, pt2, earthRadius = None):
   output distance in meter
   see https://www.movable-type.co.uk/scripts/latlong.html
   '''
-  lat1 = np.radians(pt1['lat'])
-  lat2 = np.radians(pt2['lat'])
-  lon1 = np.radians(pt1['lon'])
-  lon2 = np.radians(pt2['lon'])
-  dlon = lon2 - lon1
+  lat1 = math.radians(pt1['lat'])
+  lat2 = math.radians(pt2['lat'])
+  dlon = math.radians(pt2['lon']) - math.radians(pt1['lon'])
   dlat = lat2 - lat1
   altitude = (pt1['ele']+pt2['ele'])/2 if 'ele' in pt1 and 'ele' in pt2 else 0
 
-  a = np.sin(dlat/2) * np.sin(dlat/2) + np.cos(lat1) * np.cos(lat2) \
-      * np.sin(dlon/2) * np.sin(dlon/2)
-  c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1-a));
+  sinDLat = math.sin(dlat/2)
+  sinDLon = math.sin(dlon/2)
+  a = sinDLat * sinDLat + math.cos(lat1) * math.cos(lat2) * sinDLon * sinDLon
+  c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
 
   if not earthRadius:
     earthRadius = computeEarthRadius((pt1['lat']+pt2['lat']) / 2)
-  d = (earthRadius + altitude) * c;
+  d = (earthRadius + altitude) * c
 
   return d
 
+def computeTrack(lat, lon, ele, earthRadius, flatSpeed = FLAT_SPEED):
+  '''
+  Compute cumulative distances, ascents, descents and hiking times of a track
+  input lat, lon (WGS84 signed decimal degrees) and ele (meter) arrays
+  output (dist, time, ascent, descent, ele) arrays, ele being thresholded
+  see computeDistance and computeHikingTime for the scalar versions
+  '''
+  ele = np.array(ele, dtype=float)
+
+  # haversine formula for all the track segments
+  lat = np.radians(lat)
+  lon = np.radians(lon)
+  dlon = np.diff(lon)
+  dlat = np.diff(lat)
+  a = np.sin(dlat/2) * np.sin(dlat/2) + np.cos(lat[:-1]) * np.cos(lat[1:]) \
+      * np.sin(dlon/2) * np.sin(dlon/2)
+  c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1-a))
+  d = (earthRadius + (ele[:-1]+ele[1:])/2) * c
+  s = np.diff(ele)
+
+  # treshold slope at 50.2°
+  # a thresholded point gets the previous point elevation which changes the
+  # following segment, hence the sequential processing from the first one
+  over = np.flatnonzero(np.abs(s) > 1.2 * d)
+  if over.size:
+    for k in range(over[0], len(d)):
+      d[k] = (earthRadius + (ele[k]+ele[k+1])/2) * c[k]
+      s[k] = ele[k+1] - ele[k]
+      if abs(s[k]) > 1.2 * d[k]:
+        logger.warning(f'computed slope ({s[k]}) thresholded at 50.2')
+        ele[k+1] = ele[k]
+        s[k] = 0
+
+  # hiking time using Tobler model (see computeHikingTime)
+  ratio = flatSpeed/5.
+  km = d/1000.
+  walk = np.abs(d) >= 0.001
+  speed = 6*np.exp(-3.5*np.abs(np.divide(s/1000., km, out=np.zeros_like(km), where=walk)+0.05))
+  hours = np.where(walk, km/speed/ratio, 0)
+
+  dist = np.concatenate(([0.], np.cumsum(d)))
+  time = np.concatenate(([0.], np.cumsum(hours)))
+  ascent = np.concatenate(([0.], np.cumsum(np.where(s > 0, s, 0))))
+  descent = np.concatenate(([0.], np.cumsum(np.where(s > 0, 0, s))))
+  return dist, time, ascent, descent, ele
+
 def computeEarthRadius(lat):
   '''
   return the earth radius at sea level for the given latitude
   see: https://rechneronline.de/earth-radius/
   '''
-  lat = np.radians(lat)
-  r =   ( (RADIUS_POLE**2*np.cos(lat))**2 + (RADIUS_EQUATOR**2*np.sin(lat))**2 )     \
-      / ( (RADIUS_POLE*np.cos(lat))**2 + (RADIUS_EQUATOR*np.sin(lat))**2 )
-  r = np.sqrt(r)
+  lat = math.radians(lat)
+  cosLat = math.cos(lat)
+  sinLat = math.sin(lat)
+  r =   ( (RADIUS_POLE**2*cosLat)**2 + (RADIUS_EQUATOR**2*sinLat)**2 )     \
+      / ( (RADIUS_POLE*cosLat)**2 + (RADIUS_EQUATOR*sinLat)**2 )
+  r = math.sqrt(r)
   return r
 
 class GPX():
@@ -96,31 +176,44 @@ class GPX():
     '''
     Read GPX file
     '''
+    # stream the file: elements are processed and freed as soon as they are complete
+    depth = 0
+    i = -1
+    points = None
     try:
-      tree = ET.ElementTree(file=filename)
-      root = tree.getroot()
+      for event, elem in iterparse(str(filename), events=('start', 'end')):
+        if event == 'start':
+          depth += 1
+          if depth == 2:
+            # GPX root child
+            i += 1
+            if not 'wpt' in elem.tag and ('trk' in elem.tag or 'rte' in elem.tag):
+              points = []
+          continue
+        depth -= 1
+        if depth == 1:
+          if 'wpt' in elem.tag :
+            # GPX waypoint tag
+            pt=self.readDataElement(elem)
+            self.wayPoints.append(pt)
+          elif points is not None:
+            # GPX track tag
+            name = 'trk'+str(i)
+            for data in elem:
+              if 'name' in data.tag :
+                name = data.text
+            self.tracks.append({'name':name, 'trackPoints':np.array(points, dtype=POINT_DTYPE)})
+            points = None
+          elem.clear()
+        elif points is not None and elem.get('lat') is not None and elem.get('lon') is not None:
+          # GPX trackpoint tag
+          pt=self.readDataElement(elem)
+          points.append((pt['lat'], pt['lon'], pt['ele'], pt['time'], 0, 0, 0, pt['name']))
+          elem.clear()
     except:
       logger.error(f'unable to read gpx file "{filename}"')
       exit(-1)
 
-    for i, child in enumerate(root):
-      if 'wpt' in child.tag :
-        # GPX waypoint tag
-        pt=self.readDataElement(child)
-        self.wayPoints.append(pt)
-      elif 'trk' in child.tag or 'rte' in child.tag:
-        # GPX trackpoint tag
-        name = 'trk'+str(i)
-        for data in child:
-          if 'name' in data.tag :
-            name = data.text
-        self.tracks.append({'name':name, 'trackPoints':[]})
-        for j, trackPt in enumerate(child.findall(".//*[@lat][@lon]")):
-          pt=self.readDataElement(trackPt)
-          if not pt['time']:
-            time = 0
-          self.tracks[-1]['trackPoints'].append(pt)
-
     return len(self.tracks)
 
   def write(self, outFile, trackNum = None):
@@ -136,15 +229,20 @@ class GPX():
     root = ET.Element('gpx', {'version':'1.0'})
 
     for wp in self.wayPoints:
-      self.writeDataElement(root, 'wpt', wp)
+      self.writeDataElement(root, 'wpt', **wp)
 
     for trkList in trackList:
       trk = ET.SubElement(root, 'trk')
       e=ET.SubElement(trk, 'name')
       e.text = str(trkList['name'])
       trseg = ET.SubElement(trk, 'trkseg')
-      for tp in trkList['trackPoints']:
-        self.writeDataElement(trseg, 'trkpt', tp)
+      tp = trkList['trackPoints']
+      # distances are only meaningful once the track is processed
+      dists = tp['dist'].tolist() if 'processed' in trkList else [None] * len(tp)
+      for lat, lon, name, ele, time, dist in zip(tp['lat'].tolist(), tp['lon'].tolist(),
+                                                 tp['name'].tolist(), tp['ele'].tolist(),
+                                                 tp['time'].tolist(), dists):
+        self.writeDataElement(trseg, 'trkpt', lat, lon, name, ele, time, dist)
 
     try:
       tree = ET.ElementTree(root)
@@ -166,40 +264,30 @@ class GPX():
 
     for i, trk in enumerate (trackList):
       self.dem.getElevation(trk['trackPoints'])
-      tp0 = trk['trackPoints'][0]
-      tp0['dist'] = 0
-      tp0['time'] = 0
-      tp0['ascent'] = 0
-      tp0['descent'] = 0
-      earthRadius = computeEarthRadius(tp0['lat'])
+      tp = trk['trackPoints']
       # compute trackpoint time and other values
-      for tp1 in trk['trackPoints'][1:]:
-        d = computeDistance(tp0, tp1, earthRadius)
-        tp1['dist'] = tp0['dist'] + d
-        s = tp1['ele'] - tp0['ele']
-        # treshold slop at 50.2°
-        if abs(s) > 1.2 * d:
-          logger.warning(f'computed slope ({s}) thresholded at 50.2')
-          tp1['ele'] = tp0['ele']
-          s = 0
-        tp1['ascent'] = tp0['ascent']
-        tp1['descent'] = tp0['descent']
-        if s > 0:
-          tp1['ascent'] += s
-        else:
-          tp1['descent'] += s
-        h = computeHikingTime(d, s, self.flatSpeed)
-        tp1['time'] = tp0['time'] + h
-        tp0 = tp1
+      lat = np.ascontiguousarray(tp['lat'])
+      lon = np.ascontiguousarray(tp['lon'])
+      ele = np.ascontiguousarray(tp['ele'])
+      earthRadius = computeEarthRadius(tp[0]['lat'])
+      computeTrackKernel = getTrackKernel()
+      if computeTrackKernel:
+        *values, nbThresholded = computeTrackKernel(lat, lon, ele, earthRadius, self.flatSpeed)
+        if nbThresholded:
+          logger.warning(f'{nbThresholded} computed slopes thresholded at 50.2')
+      else:
+        values = computeTrack(lat, lon, ele, earthRadius, self.flatSpeed)
+      tp['dist'], tp['time'], tp['ascent'], tp['descent'], tp['ele'] = values
+      tp1 = tp[-1]
       # summup track values
       if not 'name' in trk:
         trk['name'] = f'track-{i+1}' if not trackNum else f'track-{tracknum+1}'
       trk['num'] = i+1
       trk['speed'] = self.flatSpeed
-      trk['ascent'] = tp1['ascent']
-      trk['descent'] = tp1['descent']
-      trk['distance'] = tp1['dist'] / 1000 #km
-      h = tp1['time'] - trk['trackPoints'][0]['time']
+      trk['ascent'] = float(tp1['ascent'])
+      trk['descent'] = float(tp1['descent'])
+      trk['distance'] = float(tp1['dist']) / 1000 #km
+      h = float(tp1['time'] - tp[0]['time'])
       trk['time'] = str(datetime.timedelta(hours=int(h), minutes=int((h % 1)*60)))
       trk['processed'] = True
 
@@ -218,10 +306,8 @@ class GPX():
     BR={'lat': 181, 'lon':-361}
     for trk in trackList:
       tp = trk['trackPoints']
-      maxLat = max(tp, key=lambda x:x['lat'])['lat']
-      maxLon = max(tp, key=lambda x:x['lon'])['lon']
-      minLat = min(tp, key=lambda x:x['lat'])['lat']
-      minLon = min(tp, key=lambda x:x['lon'])['lon']
+      minLat, maxLat = float(tp['lat'].min()), float(tp['lat'].max())
+      minLon, maxLon = float(tp['lon'].min()), float(tp['lon'].max())
       TL['lat']=max(TL['lat'],maxLat)
       TL['lon']=min(TL['lon'],minLon)
       BR['lat']=min(BR['lat'],minLat)
@@ -239,26 +325,19 @@ class GPX():
     border = 40
     distBar = 5000 # a bar every 5000m
     timeBar = 1 # a bar every 1h
-    p = pathlib.Path(__file__).parent
-    font = ImageFont.truetype(str(p.joinpath('fonts/FreeMonoBold.ttf')), 12)
+    font = getFont(12)
 
     idx = resolution - 2 * border
     idy = int(resolution / 4) - 2 * border
 
     # compute scale and shift
-    minEle = 10000
-    maxEle = -10000
-    l = []
-    time = 0
-    for j, tp in enumerate(trk['trackPoints']):
-      minEle = min(minEle, tp['ele'])
-      maxEle = max(maxEle, tp['ele'])
-      if minEle == maxEle:
-        minEle -= 10
-        maxEle += 10
-      l.append([tp['dist'],tp['ele']])
+    # (the elevation range spans at least 10m around the starting elevation)
+    tp = trk['trackPoints']
+    minEle = min(float(tp['ele'][0]) - 10, float(tp['ele'].min()))
+    maxEle = max(float(tp['ele'][0]) + 10, float(tp['ele'].max()))
+    l = np.stack([tp['dist'], tp['ele']], 1)
     shift = np.array([0, minEle])
-    scale = np.array([(idx-1)/tp['dist'], - (idy-1)/(maxEle-minEle)])
+    scale = np.array([(idx-1)/tp['dist'][-1], - (idy-1)/(maxEle-minEle)])
     refShift = np.array([0,idy-1])
 
     # prepare curve and bar drawing
@@ -266,39 +345,22 @@ class GPX():
     draw = ImageDraw.Draw(imgCurve)
 
     #draw curve
-    nl = scale * (np.array(l) - shift) + refShift
-    nl=np.concatenate((np.array([[0,idy-1]]),nl), axis = 0)
-    nl=np.concatenate((nl,np.array([[idx-1,idy-1]])), axis = 0)
-    draw.polygon([tuple(k) for k in nl], fill=colors[0])
-
-    #draw bars
-    dist = 0
-    time = 0
-    stepDist=[]
-    stepTime=[]
-    for tp in trk['trackPoints']:
-      # distance bars
-      d = int(tp['dist']/distBar)
-      if d > dist:
-        dist = d
-        r = [[tp['dist'],tp['ele']],[tp['dist'],0]]
-        nr = scale * (np.array(r) - shift) + refShift
-        stepDist.append(nr[0,0])
-        nr[0,0]-=1
-        nr[1] = [nr[1,0]+1, idy-1]
-        draw.rectangle([tuple(k) for k in nr], fill=colors[3])
-      # hour bars
-      t = int(tp['time']/timeBar)
-      if t > time:
-        time = t
-        r = [[tp['dist'],tp['ele']],[tp['dist'],0]]
-        nr = scale * (np.array(r) - shift) + refShift
-        stepTime.append(nr[0,0])
-        nr[0,0]-=1
-        nr[1] = [nr[1,0]+1, 0]
-        nr[1,1] = nr[0,1]
-        nr[0,1] = 0
-        draw.rectangle([tuple(k) for k in nr], fill=colors[1])
+    curve = scale * (l - shift) + refShift
+    nl=np.concatenate((np.array([[0,idy-1]]),curve,np.array([[idx-1,idy-1]])), axis = 0)
+    draw.polygon(nl.ravel().tolist(), fill=colors[0])
+
+    #draw bars at the points where a new distance step (or hour) is reached
+    distSteps = np.flatnonzero(np.diff((tp['dist']/distBar).astype(int), prepend=0) > 0)
+    timeSteps = np.flatnonzero(np.diff((tp['time']/timeBar).astype(int), prepend=0) > 0)
+    stepDist = curve[distSteps,0].tolist()
+    stepTime = curve[timeSteps,0].tolist()
+    # distance bars below the curve, hour bars above, drawn in track order
+    bars = [(k, [(x-1, y), (x+1, idy-1)], colors[3])
+            for k, (x, y) in zip(distSteps.tolist(), curve[distSteps].tolist())]
+    bars += [(k, [(x-1, 0), (x+1, y)], colors[1])
+             for k, (x, y) in zip(timeSteps.tolist(), curve[timeSteps].tolist())]
+    for k, rect, color in sorted(bars, key=lambda b: b[0]):
+      draw.rectangle(rect, fill=color)
     del draw
 
     # paste the curve image in a larger one containing the figure graduations
@@ -364,53 +426,39 @@ class GPX():
         # elevation
         ele = float(data.text)
       elif 'time' in data.tag :
-        # running time if exist. Try several formatting.
-        timeStr = data.text
-        try:
-          time = datetime.datetime.strptime(timeStr,'%Y-%m-%dT%H:%M:%S.%fZ')
-        except:
-          pass
-        try:
-          if not time:
-            time = datetime.datetime.strptime(timeStr,'%Y-%m-%dT%H:%M:%SZ')
-        except:
-          pass
-        try:
-          if not time:
-            time = datetime.datetime.strptime(timeStr,'%Y-%m-%d %H:%M:%S.%f')
-        except:
-          pass
+        # running time if exist
+        timeStr = data.text or ''
         try:
-          if not time:
-            time = datetime.datetime.strptime(timeStr,'%Y-%m-%d %H:%M:%S')
-        except:
-          pass
-        if time:
-          time=time.hour+time.minute/60.
-        else:
-          logger.error('invalid date-time format (expected format : %Y-%m-%dT%H:%M:%S.%fZ)\n')
+          t = datetime.datetime.fromisoformat(timeStr)
+          time = t.hour+t.minute/60.
+        except ValueError:
+          # python < 3.11 fromisoformat does not handle the trailing Z
+          m = TIME_RE.match(timeStr)
+          if m:
+            time = int(m[1])+int(m[2])/60.
+          else:
+            logger.error('invalid date-time format (expected format : %Y-%m-%dT%H:%M:%S.%fZ)\n')
     pt={'lon':lon, 'lat':lat, 'name':name, 'ele':ele, 'time':time}
     return pt
 
-  def writeDataElement(self, xmlEl, tag, data):
+  def writeDataElement(self, xmlEl, tag, lat, lon, name = None, ele = None, time = None,
+                       dist = None):
     '''
     Format GPX tags
     '''
-    attrib = {'lat':f'{data["lat"]:.5f}','lon':f'{data["lon"]:.5f}'}
-    ptEl=ET.SubElement(xmlEl, tag, attrib)
-    if 'name' in data and data['name']:
+    ptEl=ET.SubElement(xmlEl, tag, {'lat':f'{lat:.5f}','lon':f'{lon:.5f}'})
+    if name:
       e = ET.SubElement(ptEl, 'name')
-      e.text = str(data['name'])
-    if 'ele' in data and data['ele']:
+      e.text = str(name)
+    if ele:
       e = ET.SubElement(ptEl, 'ele')
-      e.text = f'{data["ele"]:.0f}'
-    if 'time' in data and data['time']:
+      e.text = f'{ele:.0f}'
+    if time:
       e = ET.SubElement(ptEl, 'time')
-      d = datetime.timedelta(hours=int(data['time']), minutes=int((data['time'] % 1)*60))
-      t = self.initialTime + d
-      # floor to millisencond -> [:-3]
-      e.text = t.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3]+'Z'
-    if 'dist' in data:
-      ET.SubElement(ptEl, 'extensions', {'km': f'{data["dist"]/1000.0:.3f}'})
+      t = self.initialTime + datetime.timedelta(hours=int(time), minutes=int((time % 1)*60))
+      # floor to millisecond
+      e.text = t.isoformat(timespec='milliseconds')+'Z'
+    if dist is not None:
+      ET.SubElement(ptEl, 'extensions', {'km': f'{dist/1000.0:.3f}'})
 
     ptEl.tail = '\n'
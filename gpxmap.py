@@ -6,16 +6,76 @@
  date: 2021
 """
 
-import io, pathlib, logging
+import os, io, math, queue, pathlib, asyncio, threading, functools, logging
+from concurrent.futures import ThreadPoolExecutor, Future, as_completed, wait
+from collections import OrderedDict
+from typing import NamedTuple
 
 import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import numpy as np
-from PIL import Image, ImageDraw, ImageColor, ImageFont
+from PIL import Image, ImageDraw, ImageFont, features
 
 from config import *
 
+try:
+  # asynchronous tile downloads if aiohttp is available
+  import aiohttp
+except ImportError:
+  aiohttp = None
+
+try:
+  # faster (anti-aliased) drawing of the track polylines if aggdraw is available
+  import aggdraw
+except ImportError:
+  aggdraw = None
+
 logger=logging.getLogger(__name__)
 
+# tile requests: HTTP statuses retried after an increasing delay, number of retries,
+# delay factor and timeout in seconds (identical for the requests and aiohttp downloads)
+RETRY_STATUS = [429, 500, 502, 503, 504]
+RETRY_TOTAL = 3
+RETRY_BACKOFF = 0.5
+TILE_TIMEOUT = 10
+
+# WebP variant of the tiles in the cache (see ENABLE_WEBP_TILE_CACHE)
+WEBP_TILES = ENABLE_WEBP_TILE_CACHE and features.check('webp')
+
+# map buffers reused from one map to the next {shape: array} (see getMapBuffer)
+_BUFFER_POOL = OrderedDict()
+# maximum size in bytes of the reused map buffers
+BUFFER_POOL_MAX_SIZE = 64*1024*1024
+
+def getMapBuffer(shape):
+  '''
+  return an uninitialized uint8 array of the given shape
+  the buffers are reused in order to avoid allocating (and page faulting) a new one for each map
+  '''
+  buf = _BUFFER_POOL.pop(shape, None)
+  if buf is None:
+    buf = np.empty(shape, dtype=np.uint8)
+  _BUFFER_POOL[shape] = buf
+  while len(_BUFFER_POOL) > 1 and sum(b.nbytes for b in _BUFFER_POOL.values()) > BUFFER_POOL_MAX_SIZE:
+    _BUFFER_POOL.popitem(last = False)
+  return buf
+
+class LL(NamedTuple):
+  '''
+  latitude and longitude (in degree), either floats or arrays
+  '''
+  lat: float
+  lon: float
+
+class XY(NamedTuple):
+  '''
+  OSM tile X and Y, either ints or arrays
+  '''
+  x: int
+  y: int
+
 class TileMap ():
   '''
   Build an opentopo map (OSM) image
@@ -23,19 +83,41 @@ class TileMap ():
     https://wiki.openstreetmap.org/wiki/Slippy_map_tilenames
     http://tools.geofabrik.de/calc/
   '''
-  def __init__(self, llBox, myCache, resolution = RESOLUTION):
+  # background downloads of the tiles surrounding the maps (see prefetchTiles)
+  prefetchQueue = None
+  prefetchSession = None
+  prefetchPending = {}
+  # background encoding of the WebP variant of the tiles (see decodeTile)
+  webpQueue = None
+  webpLock = threading.Lock()
+
+  @classmethod
+  def resetExecutors(cls):
+    '''
+    reset the background workers inherited by a forked process (but not their threads)
+    '''
+    cls.prefetchQueue = None
+    cls.prefetchSession = None
+    cls.prefetchPending = {}
+    cls.webpQueue = None
+    cls.webpLock = threading.Lock()
+
+  def __init__(self, llBox, myCache, resolution = RESOLUTION, prefetchRadius = PREFETCH_RADIUS):
     '''
-    llBox : [{'lat':NW_lat,'lon':NW_lon},{'lat':SE_lat,'lon':SE_lon}] (in degree)
+    llBox : [LL(NW_lat,NW_lon), LL(SE_lat,SE_lon)] (in degree)
 
     resolution(nbPixels) : resolution of the larger side of the bounding box
                            in the resulting map image. The actual size of the
                            map image will therefore be larger.
 
     cache : the cache directory for the OSM tiles
+
+    prefetchRadius : number of tiles around the map to be downloaded in the background
     '''
     self.mapImg = None
 
     self.cache = myCache
+    self.prefetchRadius = prefetchRadius
 
     # zoom level of the OSM tiles
     self.zoom = self.getZoom(llBox, resolution)
@@ -58,35 +140,36 @@ class TileMap ():
     return the OSM tile zoom level
     see https://wiki.openstreetmap.org/wiki/Zoom_levels
     '''
-    N = resolution/256 # pixel tiles are 256x256
+    N = resolution/TILE_PX # pixel tiles are TILE_PXxTILE_PX
 
-    a = np.abs(  np.arcsinh(np.tan(np.radians(box[0]['lat']))) \
-               - np.arcsinh(np.tan(np.radians(box[1]['lat']))) )
-    zLat = np.log(N*np.pi/a)/np.log(2)+1
+    a = abs(  math.asinh(math.tan(math.radians(box[0].lat))) \
+            - math.asinh(math.tan(math.radians(box[1].lat))) )
+    zLat = math.log2(N*math.pi/a)+1
 
-    b = np.abs(np.radians(box[1]['lon']) - np.radians(box[0]['lon']))
-    zLon = np.log(N*np.pi/b)/np.log(2)+1
+    b = abs(math.radians(box[1].lon) - math.radians(box[0].lon))
+    zLon = math.log2(N*math.pi/b)+1
 
     return int(min(zLat,zLon))
 
   def getScales(self, box, zoom):
     '''
     given lat/lon bounding box
-    compute scales (meter/pixel, lat/pixel, lon/pixel) for the map encompassing the given box
+    compute scales (meter/pixel, lat/pixel, lon/pixel and their pixel/lat, pixel/lon reciprocals) for the map encompassing the given box
     see https://wiki.openstreetmap.org/wiki/Slippy_map_tilenames#Resolution_and_Scale
     '''
-    middle = {'lat':(box[0]['lat'] + box[1]['lat'])/2.,
-              'lon':(box[0]['lon'] + box[1]['lon'])/2.}
-    meterPerPixel = 156543.03 * np.cos(middle['lat']) / (2**zoom)
+    middle = LL((box[0].lat + box[1].lat)/2., (box[0].lon + box[1].lon)/2.)
+    meterPerPixel = 156543.03 * math.cos(math.radians(middle.lat)) / (2**zoom)
 
     tile = self.LLToXY(middle)
     TL = self.XYToLL(tile)
-    BR = self.XYToLL({'x':tile['x']+1, 'y':tile['y']+1})
+    BR = self.XYToLL(XY(tile.x+1, tile.y+1))
 
-    latPerPixel = (TL['lat']-BR['lat'])/256
-    lonPerPixel = (BR['lon']-TL['lon'])/256
+    latPerPixel = (TL.lat-BR.lat)/TILE_PX
+    lonPerPixel = (BR.lon-TL.lon)/TILE_PX
 
-    return {'meterPerPixel':meterPerPixel, 'latPerPixel':latPerPixel, 'lonPerPixel':lonPerPixel}
+    # the reciprocals allow to convert lat/lon into pixels with multiplications
+    return {'meterPerPixel':meterPerPixel, 'latPerPixel':latPerPixel, 'lonPerPixel':lonPerPixel,
+            'pixelPerLat':1./latPerPixel, 'pixelPerLon':1./lonPerPixel}
 
   def getMapBBoxXY(self, box):
     '''
@@ -94,8 +177,9 @@ class TileMap ():
     return the OSM tile_X,tile_Y bounding box of the tiled map
     '''
     TL = self.LLToXY(box[0])
-    BR = self.LLToXY(box[1])
-    BR = {'x':BR['x']+1, 'y':BR['y']+1}
+    # the SE tile is excluded: no extra tile when the box ends on a tile boundary
+    BR = self.LLToXY(box[1], exact = True)
+    BR = XY(max(math.ceil(BR.x - 1e-9), TL.x+1), max(math.ceil(BR.y - 1e-9), TL.y+1))
     return [TL, BR]
 
   def getMapBBoxLL(self, box):
@@ -107,31 +191,51 @@ class TileMap ():
     BR = self.XYToLL(box[1])
     return [TL, BR]
 
-  def LLToXY(self, latlon, zoom = None):
+  def tileFilename(self, x, y, ext = 'png'):
+    '''
+    return the cache filename of the x,y tile at the map zoom level
+    ext: png for the downloaded tile or webp for its WebP variant
+    '''
+    return f'OTM-{self.zoom}-{x}-{y}.{ext}'
+
+  def LLToXY(self, latlon, zoom = None, exact = False):
     '''
     return tile_X and tile_Y containing the given coordinates at zoom level
+    latlon is a LL of either floats or arrays (e.g. track points),
+    the tiles being then returned as arrays
+    exact: return the fractional tile coordinates instead
     '''
     if not zoom:
       zoom = self.zoom
 
-    lat_rad = np.radians(latlon['lat'])
     n = 2.0 ** zoom
-    x = int((latlon['lon'] + 180.0) / 360.0 * n)
-    y = int((1.0 - np.arcsinh(np.tan(lat_rad)) / np.pi) / 2.0 * n)
+    if not isinstance(latlon.lat, np.ndarray):
+      lat_rad = math.radians(latlon.lat)
+      x = (latlon.lon + 180.0) / 360.0 * n
+      y = (1.0 - math.asinh(math.tan(lat_rad)) / math.pi) / 2.0 * n
+      return XY(x, y) if exact else XY(math.floor(x), math.floor(y))
 
-    return {'x':x, 'y':y}
+    lat_rad = np.radians(latlon.lat)
+    x = (latlon.lon + 180.0) / 360.0 * n
+    y = (1.0 - np.arcsinh(np.tan(lat_rad)) / np.pi) / 2.0 * n
+    return XY(x, y) if exact else XY(np.floor(x).astype(np.int32), np.floor(y).astype(np.int32))
 
   def XYToLL(self, xyTile, zoom = None):
     '''
     return the coordinates (lat,lon) of the given tile upper left corner
+    xyTile is a XY of either ints or arrays
     '''
     if not zoom:
       zoom = self.zoom
     n = 2.0 ** zoom
-    lon_deg = xyTile['x'] / n * 360.0 - 180.0
-    lat_rad = np.arctan(np.sinh(np.pi * (1 - 2 * xyTile['y'] / n)))
-    lat_deg = lat_rad * 180.0 / np.pi
-    return {'lat':lat_deg, 'lon':lon_deg}
+    lon_deg = xyTile.x / n * 360.0 - 180.0
+    if not isinstance(xyTile.y, np.ndarray):
+      lat_rad = math.atan(math.sinh(math.pi * (1 - 2 * xyTile.y / n)))
+      lat_deg = math.degrees(lat_rad)
+    else:
+      lat_rad = np.arctan(np.sinh(np.pi * (1 - 2 * xyTile.y / n)))
+      lat_deg = lat_rad * 180.0 / np.pi
+    return LL(lat_deg, lon_deg)
 
   def getMap(self):
     '''
@@ -139,53 +243,292 @@ class TileMap ():
     and a cache directory
     '''
 
-    dx = self.mapBBoxXY[1]['x'] - self.mapBBoxXY[0]['x']
-    dy = self.mapBBoxXY[1]['y'] - self.mapBBoxXY[0]['y']
-
-    mapImg = Image.new('RGB', (dx*256, dy*256))
+    dx = self.mapBBoxXY[1].x - self.mapBBoxXY[0].x
+    dy = self.mapBBoxXY[1].y - self.mapBBoxXY[0].y
 
     logger.info(f'retrieving {dx*dy} OpenTopoMap tiles at scale {self.zoom}')
 
-    # get the tiles and paste them in the image
-    for i in range(0, dx):
-      for j in range(0, dy):
-        x = self.mapBBoxXY[0]['x'] + i
-        y = self.mapBBoxXY[0]['y'] + j
-
-        # try to load tile from cache
-        tileCacheFilename = f'OTM-{self.zoom}-{x}-{y}.png'
-        tile = self.cache.loadData(tileCacheFilename)
-
-        # if not present in the cache, download the tile and update the cache
-        if not tile:
-          logger.info(f'downloading OpenTopoMap tile {tileCacheFilename}')
-          try:
-            with requests.Session() as s:
-              r = s.get(URL_MAP.format(self.zoom,x,y))
-              r.raise_for_status()
-              tile = r.content
-              self.cache.saveData(tileCacheFilename, tile)
-          except requests.exceptions.HTTPError as e:
-            logger.error(f'unable to download OpenTopoMap tile {self.zoom}-{x}-{y} from server (HTTP error: {e.response.status_code})')
-            print(e)
-            continue
-
-        # paste the tile image in the map
-        imgTile = Image.open(io.BytesIO(tile))
-        mapImg.paste(imgTile, (i*imgTile.size[0], j*imgTile.size[1]))
-        del imgTile
+    xy = {(i,j): (self.mapBBoxXY[0].x + i, self.mapBBoxXY[0].y + j)
+          for i in range(0, dx) for j in range(0, dy)}
+    names = {k: self.tileFilename(x, y) for k, (x, y) in xy.items()}
+
+    # copy the tiles in the map buffer (left blank where a tile is missing)
+    mapArray = getMapBuffer((dy*TILE_PX, dx*TILE_PX, 3))
+    def blit(k, tile):
+      i, j = k
+      tileArray = mapArray[j*TILE_PX:(j+1)*TILE_PX, i*TILE_PX:(i+1)*TILE_PX]
+      if tile is None:
+        tileArray[:] = 255
+      else:
+        tileArray[:] = tile
+
+    # the tiles already decoded in memory are copied right away
+    toLoad = []
+    for k, name in names.items():
+      tile = self.cache.getImage(name)
+      if tile is None:
+        toLoad.append(k)
+      else:
+        blit(k, tile)
+
+    # the other tiles are decoded concurrently (the PNG decoder releases the GIL)
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as decodePool:
+      futures = {}
+      missing = []
+      # read the WebP variant of the tiles first
+      if WEBP_TILES:
+        webpNames = [self.tileFilename(*xy[k], 'webp') for k in toLoad]
+        loaded = []
+        for k, data in zip(toLoad, self.cache.loadManyData(webpNames)):
+          if data:
+            futures[decodePool.submit(self.decodeTile, *xy[k], data)] = k
+            loaded.append(k)
+        toLoad = [k for k in toLoad if not k in loaded]
+
+      # read the tiles present in the cache in a single pass
+      for k, data in zip(toLoad, self.cache.loadManyData([names[k] for k in toLoad])):
+        if data:
+          futures[decodePool.submit(self.decodeTile, *xy[k], data)] = k
+        else:
+          missing.append(k)
+
+      # wait for the tiles being downloaded in the background rather than downloading them again
+      pending = [(k, TileMap.prefetchPending.get(names[k])) for k in missing]
+      pending = [(k, f) for k, f in pending if f]
+      if pending:
+        wait([f for k, f in pending])
+        loaded = []
+        for (k, f), data in zip(pending, self.cache.loadManyData([names[k] for k, f in pending])):
+          if data:
+            futures[decodePool.submit(self.decodeTile, *xy[k], data)] = k
+            loaded.append(k)
+        missing = [k for k in missing if not k in loaded]
+
+      # download the tiles not present in the cache concurrently and update the cache,
+      # each tile being decoded as soon as it is downloaded
+      if missing:
+        downloads = self.downloadTiles([xy[k] for k in missing],
+                                       lambda x, y, tile: decodePool.submit(self.decodeTile, x, y, tile))
+        futures.update({f: k for k, f in zip(missing, downloads)})
+
+      # copy the tiles as they are decoded
+      for f in as_completed(futures):
+        blit(futures[f], f.result())
+
+    # the RGB pixels are copied by PIL, the buffer can therefore be reused by the next map
+    mapImg = Image.fromarray(mapArray)
+
+    # warm the cache with the surrounding tiles for the neighbouring maps
+    if self.prefetchRadius:
+      self.prefetchTiles(self.prefetchRadius)
 
     return mapImg
 
+  def getTileList(self, missing = False):
+    '''
+    return the x,y list of the map tiles (only those not in the cache if missing is set)
+    '''
+    TL, BR = self.mapBBoxXY
+    return [(x, y) for x in range(TL.x, BR.x) for y in range(TL.y, BR.y)
+            if not (missing and self.cache.exists(self.tileFilename(x, y)))]
+
+  def prefetchTiles(self, radius, inner = False):
+    '''
+    download in the background the tiles within radius tiles around the map
+    (and those of the map if inner is set) that are not in the cache yet.
+    The downloaded tiles are only stored in the cache.
+    '''
+    TL, BR = self.mapBBoxXY
+    n = 2 ** self.zoom
+    xyList = [(x, y) for x in range(max(TL.x - radius, 0), min(BR.x + radius, n))
+                     for y in range(max(TL.y - radius, 0), min(BR.y + radius, n))
+              if inner or not (TL.x <= x < BR.x and TL.y <= y < BR.y)]
+
+    cls = TileMap
+    if not cls.prefetchQueue:
+      cls.startPrefetch()
+    for x, y in xyList:
+      tileCacheFilename = self.tileFilename(x, y)
+      if tileCacheFilename in cls.prefetchPending or self.cache.exists(tileCacheFilename):
+        continue
+      future = Future()
+      cls.prefetchPending[tileCacheFilename] = future
+      future.add_done_callback(lambda f, name=tileCacheFilename: cls.prefetchPending.pop(name, None))
+      cls.prefetchQueue.put((future, functools.partial(self.downloadTile, cls.prefetchSession,
+                                                     x, y, streamToCache = True)))
+
+  @classmethod
+  def startPrefetch(cls, workers = 4):
+    '''
+    start the threads downloading the tiles queued by prefetchTiles
+    '''
+    cls.prefetchSession = cls.getSession(workers)
+    cls.prefetchQueue = cls.startWorkers(workers)
+
+  @classmethod
+  def startWorkers(cls, workers):
+    '''
+    start threads running the (future, function) jobs put in the returned queue
+    unlike those of an executor, these are daemon threads: the jobs
+    still queued do not delay the program exit
+    '''
+    jobs = queue.Queue()
+    for i in range(workers):
+      threading.Thread(target=cls.runJobs, args=(jobs,), daemon=True).start()
+    return jobs
+
+  @staticmethod
+  def runJobs(jobs):
+    '''
+    run the (future, function) jobs of the queue
+    '''
+    while True:
+      future, fn = jobs.get()
+      if future.set_running_or_notify_cancel():
+        try:
+          future.set_result(fn())
+        except Exception as e:
+          future.set_exception(e)
+
+  def decodeTile(self, x, y, tile):
+    '''
+    return the given x,y tile data decoded as a RGB array, or None
+    the decoded tile is kept in memory by the cache for the next maps
+    and, for the PNG tiles, stored in the background as WebP if WEBP_TILES is set
+    '''
+    if not tile:
+      return None
+    img = Image.open(io.BytesIO(tile))
+    # decode now, in the calling (decoding) thread
+    img.load()
+    # convert returns a copy even when the tile is already RGB
+    tileArray = np.asarray(img if img.mode == 'RGB' else img.convert('RGB'))
+    if WEBP_TILES and tile.startswith(b'\x89PNG'):
+      cls = TileMap
+      with cls.webpLock:
+        if not cls.webpQueue:
+          cls.webpQueue = cls.startWorkers(2)
+      cls.webpQueue.put((Future(), functools.partial(self.saveWebPTile, x, y, tileArray)))
+    return self.cache.keepImage(self.tileFilename(x, y), tileArray)
+
+  def saveWebPTile(self, x, y, tileArray):
+    '''
+    store the decoded x,y tile in the cache as a lossless WebP image
+    '''
+    buf = io.BytesIO()
+    Image.fromarray(tileArray).save(buf, 'WEBP', lossless=True)
+    self.cache.saveData(self.tileFilename(x, y, 'webp'), buf.getvalue())
+
+  def downloadTiles(self, xyList, onDownload = None):
+    '''
+    download concurrently the given x,y tiles from openTopoMap and store them in the cache
+    onDownload: optional function called with x, y and the tile data as soon as it is downloaded,
+                its result replacing the tile data in the returned list
+    return the list of tile data (None for the failed downloads)
+    '''
+    if aiohttp:
+      return asyncio.run(self.downloadTilesAsync(xyList, onDownload))
+
+    # one session for all the tiles (keep-alive)
+    with self.getSession(DOWNLOAD_WORKERS) as s, \
+         ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+      if onDownload:
+        return list(executor.map(lambda xy: onDownload(*xy, self.downloadTile(s, *xy)), xyList))
+      return list(executor.map(lambda xy: self.downloadTile(s, *xy), xyList))
+
+  @staticmethod
+  def getSession(connections):
+    '''
+    return a requests session for the given number of concurrent tile downloads
+    retrying on rate limit and server errors (RETRY_STATUS)
+    '''
+    adapter = HTTPAdapter(pool_connections=connections, pool_maxsize=connections,
+                          max_retries=Retry(total=RETRY_TOTAL, backoff_factor=RETRY_BACKOFF,
+                                            raise_on_status=False, status_forcelist=RETRY_STATUS))
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+  async def downloadTilesAsync(self, xyList, onDownload = None):
+    '''
+    asynchronous version of downloadTiles using aiohttp
+    '''
+    semaphore = asyncio.Semaphore(DOWNLOAD_WORKERS)
+    connector = aiohttp.TCPConnector(limit=DOWNLOAD_WORKERS)
+    timeout = aiohttp.ClientTimeout(total=TILE_TIMEOUT)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+      async def download(x, y):
+        tile = await self.downloadTileAsync(session, semaphore, x, y)
+        return onDownload(x, y, tile) if onDownload else tile
+      return await asyncio.gather(*[download(x, y) for x, y in xyList])
+
+  async def downloadTileAsync(self, session, semaphore, x, y,
+                              retries = RETRY_TOTAL, backoff = RETRY_BACKOFF):
+    '''
+    download the x,y tile from openTopoMap and store it in the cache
+    retry after an increasing delay when the server limits the request rate
+    or fails (RETRY_STATUS)
+    return the tile data or None
+    '''
+    tileCacheFilename = self.tileFilename(x, y)
+    async with semaphore:
+      logger.info(f'downloading OpenTopoMap tile {tileCacheFilename}')
+      for attempt in range(retries + 1):
+        try:
+          async with session.get(URL_MAP.format(self.zoom,x,y)) as r:
+            if r.status in RETRY_STATUS and attempt < retries:
+              delay = r.headers.get('Retry-After', '')
+              await asyncio.sleep(float(delay) if delay.isdigit() else backoff * 2**attempt)
+              continue
+            r.raise_for_status()
+            tile = await r.read()
+        except aiohttp.ClientResponseError as e:
+          logger.error(f'unable to download OpenTopoMap tile {self.zoom}-{x}-{y} from server (HTTP error: {e.status})')
+          return None
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+          logger.error(f'unable to download OpenTopoMap tile {self.zoom}-{x}-{y} from server ({e!r})')
+          return None
+        self.cache.saveData(tileCacheFilename, tile)
+        return tile
+
+  def downloadTile(self, session, x, y, streamToCache = False):
+    '''
+    download the x,y tile from openTopoMap and store it in the cache
+    streamToCache: write the tile directly in the cache file without keeping it in memory
+    return the tile data or None
+    '''
+    tileCacheFilename = self.tileFilename(x, y)
+    logger.info(f'downloading OpenTopoMap tile {tileCacheFilename}')
+    tile = None
+    try:
+      with session.get(URL_MAP.format(self.zoom,x,y), stream=True, timeout=TILE_TIMEOUT) as r:
+        r.raise_for_status()
+        # the body length is checked against Content-Length while reading
+        r.raw.decode_content = True
+        if streamToCache:
+          self.cache.saveStream(tileCacheFilename, r.raw)
+        else:
+          # read the tile in a single buffer rather than joining chunks
+          tile = r.raw.read()
+          self.cache.saveData(tileCacheFilename, tile)
+    except requests.exceptions.HTTPError as e:
+      logger.error(f'unable to download OpenTopoMap tile {self.zoom}-{x}-{y} from server (HTTP error: {e.response.status_code})')
+      tile = None
+    except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError) as e:
+      logger.error(f'unable to download OpenTopoMap tile {self.zoom}-{x}-{y} from server ({e})')
+      tile = None
+    return tile
+
   def cropMap(self, box):
     '''
     extract the portion of the map corresponding to the given box (lat,lon)
     '''
     # compute the coordinate of the (lat,lon) box in the map
-    nBox = ((box[0]['lon'] - self.mapBBoxLL[0]['lon']) / self.scales['lonPerPixel'],
-            (self.mapBBoxLL[0]['lat'] - box[0]['lat']) / self.scales['latPerPixel'],
-            (box[1]['lon'] - self.mapBBoxLL[0]['lon']) / self.scales['lonPerPixel'],
-            (self.mapBBoxLL[0]['lat'] - box[1]['lat']) / self.scales['latPerPixel'])
+    nBox = ((box[0].lon - self.mapBBoxLL[0].lon) * self.scales['pixelPerLon'],
+            (self.mapBBoxLL[0].lat - box[0].lat) * self.scales['pixelPerLat'],
+            (box[1].lon - self.mapBBoxLL[0].lon) * self.scales['pixelPerLon'],
+            (self.mapBBoxLL[0].lat - box[1].lat) * self.scales['pixelPerLat'])
 
     return self.mapImg.crop(nBox)
 
@@ -216,25 +559,33 @@ class TileMap ():
 
     del draw
 
+if hasattr(os, 'register_at_fork'):
+  os.register_at_fork(after_in_child=TileMap.resetExecutors)
+
 class GPXMap (TileMap):
   '''
   Build an opentopo map (OSM) image and plot GPX tracks
   '''
-  def __init__(self, gpx, trackNum = None, resolution = RESOLUTION, cache = None):
+  def __init__(self, gpx, trackNum = None, resolution = RESOLUTION, cache = None,
+               prefetchRadius = PREFETCH_RADIUS, prefetchOnly = False, tilesOnly = False):
     '''
     resolution(nbPixels) : resolution of the larger side of the resulting map image
                            (depends on the given lat/lon bounding box)
     TrackNum: plot the given track or tracks if None
     cache : the cache directory for the OSM tiles
+    prefetchRadius : number of tiles around the map to be downloaded in the background
+    prefetchOnly : do not build the map, only download its tiles in the background
+    tilesOnly : do not build the map, only compute its tiles (see getTileList)
     '''
 
     self.mapImg = None
     self.gpx = gpx
     self.resolution = resolution
     self.cache = cache
+    self.prefetchRadius = prefetchRadius
 
     # get the gpx boudingbox square for the given track number
-    self.llBox = gpx.getBoundingBox(trackNum)
+    self.llBox = [LL(pt['lat'], pt['lon']) for pt in gpx.getBoundingBox(trackNum)]
 
     # zoom level of the OSM tiles
     self.zoom = self.getZoom(self.llBox, resolution)
@@ -252,6 +603,13 @@ class GPXMap (TileMap):
     # [NW, SE] tiled map lat,lon boundingBox
     self.mapBBoxLL = self.getMapBBoxLL(self.mapBBoxXY)
 
+    if tilesOnly:
+      return
+
+    if prefetchOnly:
+      self.prefetchTiles(self.prefetchRadius, inner = True)
+      return
+
     # download the tiles and make a map
     self.mapImg = self.getMap()
 
@@ -269,13 +627,13 @@ class GPXMap (TileMap):
     reshape the box in order to obtain a square resolutionxresolution image
     with the given lat/lon bounding box at the center
     '''
-    dx = (self.resolution - (box[1]['lon'] - box[0]['lon']) / self.scales['lonPerPixel']) / 2
-    dy = (self.resolution - (box[0]['lat'] - box[1]['lat']) / self.scales['latPerPixel']) / 2
+    dx = (self.resolution - (box[1].lon - box[0].lon) / self.scales['lonPerPixel']) / 2
+    dy = (self.resolution - (box[0].lat - box[1].lat) / self.scales['latPerPixel']) / 2
     dlon = dx * self.scales['lonPerPixel']
     dlat = dy * self.scales['latPerPixel']
 
-    nBox= [{'lat':box[0]['lat'] + dlat, 'lon':box[0]['lon'] - dlon},
-           {'lat':box[1]['lat'] - dlat, 'lon':box[1]['lon'] + dlon}]
+    nBox= [LL(box[0].lat + dlat, box[0].lon - dlon),
+           LL(box[1].lat - dlat, box[1].lon + dlon)]
 
     return nBox
 
@@ -284,33 +642,42 @@ class GPXMap (TileMap):
 
     trackList = [self.gpx.tracks[trackNum]] if trackNum!=None else self.gpx.tracks
 
-    draw = ImageDraw.Draw(self.mapImg)
-
-    # create the lists of track point in pixels
+    # create the arrays of track point in pixels
     ptList = []
     for trk in trackList:
-      ptList.append([])
-      for tp in trk['trackPoints']:
-        ptList[-1].append(((tp['lon'] - self.mapBBoxLL[0]['lon']) \
-                           / self.scales['lonPerPixel'],
-                           (self.mapBBoxLL[0]['lat'] - tp['lat']) \
-                           / self.scales['latPerPixel']))
-
-    # draw a line segment between points
+      tp = trk['trackPoints']
+      xs = (tp['lon'] - self.mapBBoxLL[0].lon) * self.scales['pixelPerLon']
+      ys = (self.mapBBoxLL[0].lat - tp['lat']) * self.scales['pixelPerLat']
+      ptList.append(np.column_stack([xs, ys]))
+
+    # draw the track polyline
     c = 0
-    for l in ptList:
-      p0 = l[0]
-      for p1 in l[1:]:
-        draw.line([p0,p1], fill=COLORS[c], width=5)
-        p0 = p1
-      c = (c + 1) % len(COLORS)
+    if aggdraw:
+      draw = aggdraw.Draw(self.mapImg)
+      for l in ptList:
+        draw.line(l.ravel().tolist(), aggdraw.Pen(COLORS[c], 5))
+        c = (c + 1) % len(COLORS)
+      # copy the drawing in the map image
+      draw.flush()
 
-    # draw a circle at each point
+    draw = ImageDraw.Draw(self.mapImg)
+    if not aggdraw:
+      for l in ptList:
+        draw.line(l.ravel().tolist(), fill=COLORS[c], width=5)
+        c = (c + 1) % len(COLORS)
+
+    # draw a small circle at each point: at this size the circle is the point pixel
+    # and its 4 neighbours, drawn with one batched call per neighbour
+    # (the points being sorted by map tile so that the pixels are written tile by tile,
+    # keeping the written portion of the image in the CPU cache)
     c = 1
-    s = 1
+    nbTilesX = -(-self.mapImg.size[0] // TILE_PX)
     for l in ptList:
-      for p in l:
-        draw.ellipse([(p[0]-s,p[1]-s),(p[0]+s,p[1]+s)], fill=COLORS[c])
+      p = np.floor(l).astype(np.int32)
+      tileIdx = (p[:,1] // TILE_PX) * nbTilesX + p[:,0] // TILE_PX
+      p = p[np.argsort(tileIdx, kind='stable')]
+      for offset in ((0,0), (-1,0), (1,0), (0,-1), (0,1)):
+        draw.point((p + offset).ravel().tolist(), fill=COLORS[c])
       c = (c + 1) % len(COLORS)
 
     del draw
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+ HikeBooklet
+ author: georand
+ source: https://github.com/georand/hikebooklet
+ date: 2021
+"""
+
+# compiled versions of the track processing (optional, requires numba)
+
+import math
+
+import numpy as np
+from numba import njit
+
+@njit(cache=True, fastmath=True)
+def computeTrack(lat, lon, ele, earthRadius, flatSpeed):
+  '''
+  single pass version of gpx.computeTrack
+  input lat, lon (WGS84 signed decimal degrees) and ele (meter) float64 arrays
+  output (dist, time, ascent, descent, ele, number of thresholded slopes)
+  '''
+  n = lat.shape[0]
+  dist = np.zeros(n)
+  time = np.zeros(n)
+  ascent = np.zeros(n)
+  descent = np.zeros(n)
+  ele = ele.copy()
+  nbThresholded = 0
+
+  # speed ratio to be applied to the default flat speed for tobler method (5km/h)
+  ratio = flatSpeed/5.
+
+  lat0 = math.radians(lat[0])
+  lon0 = math.radians(lon[0])
+  for k in range(1, n):
+    lat1 = math.radians(lat[k])
+    lon1 = math.radians(lon[k])
+
+    # haversine formula
+    dlat = lat1 - lat0
+    dlon = lon1 - lon0
+    a = math.sin(dlat/2) * math.sin(dlat/2) + math.cos(lat0) * math.cos(lat1) \
+        * math.sin(dlon/2) * math.sin(dlon/2)
+    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
+    d = (earthRadius + (ele[k-1]+ele[k])/2) * c
+
+    # treshold slope at 50.2°
+    s = ele[k] - ele[k-1]
+    if abs(s) > 1.2 * d:
+      ele[k] = ele[k-1]
+      s = 0.
+      nbThresholded += 1
+
+    dist[k] = dist[k-1] + d
+    ascent[k] = ascent[k-1] + (s if s > 0 else 0.)
+    descent[k] = descent[k-1] + (0. if s > 0 else s)
+
+    # Tobler model
+    time[k] = time[k-1]
+    if abs(d) >= 0.001:
+      speed = 6*math.exp(-3.5*abs(s/d+0.05))
+      time[k] += d/1000./speed/ratio
+
+    lat0 = lat1
+    lon0 = lon1
+
+  return dist, time, ascent, descent, ele, nbThresholded
@@ -10,10 +10,6 @@
 import sys, argparse, pathlib, logging
 
 from config import *
-from cache import CacheDir as Cache
-from dem import DEM
-from gpx import GPX
-from booklet import Booklet
 
 if __name__ == "__main__":
 
@@ -35,6 +31,13 @@ if __name__ == "__main__":
                       help='directory path where resulting data will be stored')
   args = parser.parse_args()
 
+  # numpy, PIL and requests take a while to load, so they are only imported
+  # once the arguments are known to be valid
+  from cache import CacheDir as Cache
+  from dem import DEM
+  from gpx import GPX
+  from booklet import Booklet
+
   logLevel = max(10, 30 - args.verbose * 10) # ERROR:40, WARNING:30 INFO:20 DEBUG:10
 
   logging.basicConfig(level=logLevel, format='%(name)s - %(levelname)s - %(message)s',
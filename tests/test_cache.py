@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+ HikeBooklet
+ author: georand
+ source: https://github.com/georand/hikebooklet
+ date: 2021
+"""
+
+# cache directory index and eviction
+# run with: python -m unittest discover -s tests
+
+import io, os, sys, random, pathlib, tempfile, unittest
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1]))
+
+from cache import CacheDir
+
+# cache max size in MB: 10 files of 1000 bytes
+MAX_SIZE = 10000 / 1024 / 1024
+
+class CacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmpDir = tempfile.TemporaryDirectory()
+    self.cache = self.newCache()
+    random.seed(0)
+
+  def tearDown(self):
+    self.tmpDir.cleanup()
+
+  def newCache(self):
+    return CacheDir(self.tmpDir.name, MAX_SIZE, keep = ['keep.dat'], priority = ['*.raw'])
+
+  def save(self, filename, size = 1000):
+    self.cache.saveData(filename, b'x' * size)
+
+  def assertConsistent(self):
+    '''
+    check the index, the size and the tiers of the cache against its directory
+    '''
+    cache = self.cache
+    files = {e.name: e.stat().st_size for e in os.scandir(cache.path) if e.is_file()}
+    self.assertEqual({name: entry[0] for name, entry in cache.index.items()}, files)
+    self.assertEqual(cache.size, sum(files.values()))
+    for tier, candidates in enumerate(cache.tiers):
+      for position, filename in enumerate(candidates):
+        self.assertEqual(cache.index[filename][3:], [tier, position])
+    self.assertEqual(sorted(f for candidates in cache.tiers for f in candidates),
+                     sorted(f for f in files if f != 'keep.dat'))
+
+  def testMixedOperations(self):
+    names = [f'{i}.png' for i in range(20)] + [f'{i}.raw' for i in range(5)] + ['keep.dat']
+    for i in range(300):
+      filename = random.choice(names)
+      op = random.randrange(6)
+      if op == 0:
+        self.cache.remove(filename)
+      elif op == 1:
+        self.cache.loadData(filename)
+      elif op == 2:
+        self.cache.loadManyData(random.sample(names, 3))
+      elif op == 3:
+        self.cache.saveStream(filename, io.BytesIO(b'x' * random.randint(1, 2000)))
+      elif op == 4 and i % 10 == 0:
+        self.cache.scan()
+      else:
+        self.save(filename, random.randint(1, 2000))
+      self.assertConsistent()
+
+  def testScanKeepsHits(self):
+    self.save('a.png')
+    for i in range(3):
+      self.cache.loadData('a.png')
+    self.cache.scan()
+    self.assertEqual(self.cache.index['a.png'][2], 3)
+    self.assertConsistent()
+
+  def testScanWritesOfOtherProcess(self):
+    other = self.newCache()
+    for i in range(5):
+      other.saveData(f'{i}.png', b'x' * 1000)
+    self.cache.scan()
+    self.assertConsistent()
+
+  def testRemoveEntry(self):
+    for i in range(5):
+      self.save(f'{i}.png', 100)
+    for filename in ('2.png', '4.png', '0.png'):
+      with self.cache.lock:
+        self.cache.removeEntry(filename)
+      self.assertNotIn(filename, self.cache.tiers[0])
+      for position, f in enumerate(self.cache.tiers[0]):
+        self.assertEqual(self.cache.index[f][4], position)
+    self.assertEqual(sorted(self.cache.tiers[0]), ['1.png', '3.png'])
+
+  def testPinnedNeverRemoved(self):
+    self.save('pinned.png')
+    # pinned before being written
+    self.cache.pin('next.png')
+    self.save('next.png')
+    self.cache.pin('pinned.png')
+    for i in range(50):
+      self.save(f'{i}.png')
+      self.assertTrue(self.cache.exists('pinned.png'))
+      self.assertTrue(self.cache.exists('next.png'))
+    self.cache.unpin('pinned.png')
+    for i in range(50):
+      self.save(f'{i}.png')
+    self.assertFalse(self.cache.exists('pinned.png'))
+    self.assertTrue(self.cache.exists('next.png'))
+    self.assertConsistent()
+
+  def testRecentNeverRemoved(self):
+    for i in range(30):
+      # larger than the cache on its own
+      self.save(f'{i}.png', 6000)
+      self.assertTrue(self.cache.exists(f'{i}.png'))
+      if i:
+        self.assertTrue(self.cache.exists(f'{i-1}.png'))
+    self.assertConsistent()
+
+  def testKeepNeverRemoved(self):
+    self.save('keep.dat')
+    for i in range(50):
+      self.save(f'{i}.png')
+    self.assertTrue(self.cache.exists('keep.dat'))
+
+  def testPriorityRemovedLast(self):
+    for i in range(3):
+      self.save(f'{i}.raw', 2500)
+    for i in range(10):
+      self.save(f'{i}.png', 4000)
+      raw = [f for f in self.cache.index if f.endswith('.raw')]
+      if len(raw) < 3:
+        # only the last written files are left in tier 0
+        self.assertTrue(all(f in self.cache.recent for f in self.cache.tiers[0]))
+    self.assertLess(len(raw), 3)
+    self.assertConsistent()
+
+  def testKeepPriority(self):
+    self.cache.keepPriority = True
+    for i in range(8):
+      self.save(f'{i}.raw')
+    for i in range(50):
+      self.save(f'{i}.png')
+    self.assertEqual(len([f for f in self.cache.index if f.endswith('.raw')]), 8)
+    self.assertConsistent()
+
+if __name__ == '__main__':
+  unittest.main()
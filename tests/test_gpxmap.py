@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+ HikeBooklet
+ author: georand
+ source: https://github.com/georand/hikebooklet
+ date: 2021
+"""
+
+# tile downloads against a failing local tile server, for both the aiohttp
+# and the requests download paths
+# run with: python -m unittest discover -s tests
+
+import sys, socket, pathlib, tempfile, threading, logging, unittest, http.server
+from unittest import mock
+from concurrent import futures
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1]))
+
+import gpxmap
+from cache import CacheDir
+
+class TileHandler(http.server.BaseHTTPRequestHandler):
+  '''
+  tile server answering according to the tile path:
+    /{z}/{x}/{y}.png : 503 for the first request of the tile, then the tile
+    /{z}/{x}/{y}fail.png : always 503
+  '''
+  protocol_version = 'HTTP/1.1'
+  hits = {}
+
+  def do_GET(self):
+    n = self.hits[self.path] = self.hits.get(self.path, 0) + 1
+    if n == 1 or self.path.endswith('fail.png'):
+      self.send_response(503)
+      self.send_header('Content-Length', '0')
+      self.end_headers()
+      return
+    self.send_response(200)
+    self.send_header('Content-Length', '4')
+    self.end_headers()
+    self.wfile.write(b'tile')
+
+  def log_message(self, *args):
+    pass
+
+class DownloadTest():
+  '''
+  download tests, run for each download path (see below)
+  '''
+  aiohttp = None
+
+  @classmethod
+  def setUpClass(cls):
+    cls.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), TileHandler)
+    threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+  @classmethod
+  def tearDownClass(cls):
+    cls.server.shutdown()
+    cls.server.server_close()
+
+  def setUp(self):
+    self.tmpDir = tempfile.TemporaryDirectory()
+    self.tileMap = gpxmap.TileMap.__new__(gpxmap.TileMap)
+    self.tileMap.cache = CacheDir(self.tmpDir.name, 1)
+    self.tileMap.zoom = 1
+    TileHandler.hits.clear()
+    self.patches = [mock.patch.object(gpxmap, 'aiohttp', self.aiohttp),
+                    mock.patch.object(gpxmap, 'RETRY_BACKOFF', 0.)]
+    for p in self.patches:
+      p.start()
+    logging.disable(logging.ERROR)
+
+  def tearDown(self):
+    logging.disable(logging.NOTSET)
+    for p in self.patches:
+      p.stop()
+    self.tmpDir.cleanup()
+
+  def setURL(self, port, suffix = ''):
+    p = mock.patch.object(gpxmap, 'URL_MAP', f'http://127.0.0.1:{port}/{{}}/{{}}/{{}}{suffix}.png')
+    p.start()
+    self.patches.append(p)
+
+  def testRetry(self):
+    self.setURL(self.server.server_address[1])
+    self.assertEqual(self.tileMap.downloadTiles([(0, 0)]), [b'tile'])
+    self.assertEqual(TileHandler.hits, {'/1/0/0.png': 2})
+    self.assertTrue(self.tileMap.cache.exists(self.tileMap.tileFilename(0, 0)))
+
+  def testServerError(self):
+    self.setURL(self.server.server_address[1], 'fail')
+    self.assertEqual(self.tileMap.downloadTiles([(0, 0), (1, 0)]), [None, None])
+    self.assertEqual(TileHandler.hits['/1/0/0fail.png'], gpxmap.RETRY_TOTAL + 1)
+
+  def testConnectionRefused(self):
+    # port with no server
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    self.setURL(port)
+    self.assertEqual(self.tileMap.downloadTiles([(0, 0), (1, 0)]), [None, None])
+
+@unittest.skipIf(gpxmap.aiohttp is None, 'aiohttp is not installed')
+class AiohttpDownloadTest(DownloadTest, unittest.TestCase):
+  aiohttp = gpxmap.aiohttp
+
+class RequestsDownloadTest(DownloadTest, unittest.TestCase):
+  aiohttp = None
+
+  def testPrefetchRetry(self):
+    self.setURL(self.server.server_address[1])
+    gpxmap.TileMap.resetExecutors()
+    self.tileMap.mapBBoxXY = [gpxmap.XY(0, 0), gpxmap.XY(1, 1)]
+    self.tileMap.prefetchTiles(0, inner = True)
+    futures.wait(list(gpxmap.TileMap.prefetchPending.values()))
+    self.assertEqual(TileHandler.hits, {'/1/0/0.png': 2})
+    self.assertTrue(self.tileMap.cache.exists(self.tileMap.tileFilename(0, 0)))
+
+if __name__ == '__main__':
+  unittest.main()